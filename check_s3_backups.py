@@ -46,12 +46,33 @@
 #
 
 import datetime
+import os
 
 import boto3
 import botocore
+from botocore.config import Config
+from dateutil.parser import isoparse
 from dateutil.tz import *
 import argparse
-import re
+import asyncio
+import csv
+import gzip
+import heapq
+import io
+import json
+import time
+import traceback
+from urllib.parse import quote_plus, unquote_plus
+from collections import deque
+from itertools import repeat
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+
+# aioboto3 is optional, without it the folders are listed by a thread pool.
+try:
+    import aioboto3
+except ImportError:
+    aioboto3 = None
 
 
 class Logger:
@@ -60,20 +81,246 @@ class Logger:
     def __init__(self, debug):
         self.debugEnabled = debug
 
-    def debug(self, message):
+    # The message is formatted with the args only when debug is enabled, so disabled debug output costs nothing.
+    def debug(self, message, *args):
         if self.debugEnabled:
-            print("DEBUG: " + message)
+            print("DEBUG: " + (message % args if args else message))
 
     def info(self, message):
         print(message)
 
 
-class S3Service:
-    def __init__(self, profile, logger = Logger(False)):
+# A Nagios status to report when the check cannot continue. Raised by the listings, also from worker threads
+# and event loop tasks, and reported once by the main script.
+class CheckError(Exception):
+    def __init__(self, message, exitcode):
+        super().__init__(message)
+        self.message = message
+        self.exitcode = exitcode
+
+
+# Youngest and oldest file, total size and count of files in a folder, collected in a single pass.
+# With sortedKeys, files are expected in the order of their age (S3 lists keys alphabetically),
+# so the first file is the oldest and the last one is the youngest.
+# With avgWindow, the average size is computed from the avgWindow youngest files only.
+class FolderStats:
+    def __init__(self, sortedKeys=False, avgWindow=0):
+        self.sortedKeys = sortedKeys
+        self.avgWindow = avgWindow
+        self.youngest = None
+        self.oldest = None
+        self.totalSize = 0
+        self.count = 0
+        # Sizes of the youngest files. A queue of sizes with sorted keys, a heap of (LastModified, Size) otherwise.
+        self.window = deque(maxlen=avgWindow) if sortedKeys else []
+
+    def add(self, file):
+        self.totalSize += file["Size"]
+        self.count += 1
+        if self.sortedKeys:
+            self.youngest = file
+            if self.oldest is None:
+                self.oldest = file
+            if self.avgWindow > 0:
+                self.window.append(file["Size"])
+            return
+
+        lastModified = file["LastModified"]
+        if self.youngest is None or lastModified > self.youngest["LastModified"]:
+            self.youngest = file
+        if self.oldest is None or lastModified <= self.oldest["LastModified"]:
+            self.oldest = file
+        if self.avgWindow > 0:
+            self.addToWindow(lastModified, file["Size"])
+
+    # Convert the stats to and from a JSON compatible dict, so they can be cached between runs.
+    def toDict(self):
+        return {
+            "youngest": FolderStats.fileToDict(self.youngest),
+            "oldest": FolderStats.fileToDict(self.oldest),
+            "totalSize": self.totalSize,
+            "count": self.count,
+            "window": list(self.window),
+        }
+
+    @staticmethod
+    def fromDict(data, sortedKeys=False, avgWindow=0):
+        stats = FolderStats(sortedKeys, avgWindow)
+        stats.youngest = FolderStats.fileFromDict(data["youngest"])
+        stats.oldest = FolderStats.fileFromDict(data["oldest"])
+        stats.totalSize = data["totalSize"]
+        stats.count = data["count"]
+        stats.window.extend(data["window"])
+        return stats
+
+    @staticmethod
+    def fileToDict(file):
+        return {
+            "Key": file["Key"],
+            "Size": file["Size"],
+            "LastModified": file["LastModified"].isoformat(),
+            "StorageClass": file.get("StorageClass", ""),
+        }
+
+    @staticmethod
+    def fileFromDict(data):
+        return dict(data, LastModified=isoparse(data["LastModified"]))
+
+    # Add the stats of files scanned separately. With sortedKeys, the other files must come after these in the key order.
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.totalSize += other.totalSize
+        self.count += other.count
+        if self.sortedKeys:
+            self.youngest = other.youngest
+            if self.oldest is None:
+                self.oldest = other.oldest
+            self.window.extend(other.window)
+            return
+
+        if self.youngest is None or other.youngest["LastModified"] > self.youngest["LastModified"]:
+            self.youngest = other.youngest
+        if self.oldest is None or other.oldest["LastModified"] <= self.oldest["LastModified"]:
+            self.oldest = other.oldest
+        for lastModified, size in other.window:
+            self.addToWindow(lastModified, size)
+
+    def addToWindow(self, lastModified, size):
+        if len(self.window) < self.avgWindow:
+            heapq.heappush(self.window, (lastModified, size))
+        elif lastModified > self.window[0][0]:
+            heapq.heapreplace(self.window, (lastModified, size))
+
+    def averageSize(self):
+        if self.avgWindow == 0:
+            return self.totalSize / self.count
+        if self.sortedKeys:
+            return sum(self.window) / len(self.window)
+        return sum(map(itemgetter(1), self.window)) / len(self.window)
+
+
+# Folder stats cached between runs of the check, stored in a JSON file per bucket.
+# An entry expires ttl seconds after the folder was fully listed, so a deleted file is noticed eventually.
+class StatsCache:
+    # Entries of another version are ignored. Version 2 entries are listed with the trailing slash of the folder,
+    # older ones may hold files of other folders sharing the name prefix.
+    version = 2
+
+    def __init__(self, bucketName, ttl, logger = Logger(False)):
+        self.path = os.path.join(os.path.expanduser("~/.cache/check_s3_backups"), f"{bucketName}.json")
+        self.ttl = ttl
+        self.logger = logger
+        self.entries = {}
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.debug("Cache %s not loaded: %s", self.path, e)
+
+    # Get the cached entry of the folder, None if there is none, it has expired or is of another version.
+    def get(self, folder):
+        entry = self.entries.get(folder)
+        if entry is None or entry.get("version") != StatsCache.version or time.time() - entry["listedAt"] > self.ttl:
+            return None
+        return entry
+
+    def put(self, folder, stats, listedAt, avgWindow):
+        self.entries[folder] = {"version": StatsCache.version, "listedAt": listedAt, "avgWindow": avgWindow,
+                                "stats": stats.toDict()}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Write to a temporary file first, so that a concurrent run never reads a partial cache.
+            temporaryPath = f"{self.path}.{os.getpid()}"
+            with open(temporaryPath, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(temporaryPath, self.path)
+        except OSError as e:
+            self.logger.debug("Cache %s not saved: %s", self.path, e)
+
+
+# Error reporting and listing helpers shared by S3Service and AsyncS3Service.
+# The maxConnections is the most requests made at the same time, the size of the connection pool.
+class BaseS3Service:
+    def __init__(self, profile, logger = Logger(False), maxConnections = 32):
         self.profile = profile
-        self.session = boto3.Session(profile_name=self.profile)
-        self.s3 = self.session.client("s3")
         self.logger = logger
+        self.maxConnections = maxConnections
+
+    def clientConfig(self):
+        # Folders are listed concurrently, so keep enough connections in the pool for all concurrent requests.
+        # TCP keep-alive keeps the pooled connections open, so the TLS handshake is not repeated for each listing.
+        # A single retry only, so that the check fails before the Nagios timeout when S3 is unreachable.
+        return Config(max_pool_connections=self.maxConnections, retries={"max_attempts": 2, "mode": "standard"},
+                      tcp_keepalive=True, connect_timeout=3, read_timeout=10)
+
+    # Get the Nagios status for an error of an S3 request. Must be called from an except block,
+    # the traceback is shown with --debug.
+    def statusError(self, e, bucketName):
+        if self.logger.debugEnabled:
+            self.logger.debug("%s", traceback.format_exc())
+        if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+            return CheckError(f"CRITICAL: Requests to the bucket {bucketName} failed ({type(e).__name__})", 2)
+        if isinstance(e, botocore.exceptions.BotoCoreError):
+            return CheckError(f"UNKNOWN: Requests to the bucket {bucketName} failed ({type(e).__name__})", 3)
+
+        errorCode = e.response["Error"]["Code"]
+        if errorCode == "NoSuchBucket":
+            return CheckError(f"CRITICAL: No bucket found with a name of {bucketName}", 2)
+        if errorCode in ("AccessDenied", "InvalidAccessKeyId", "SignatureDoesNotMatch", "ExpiredToken"):
+            return CheckError(f"UNKNOWN: Access to the bucket {bucketName} was denied ({errorCode})", 3)
+        if errorCode == "SlowDown":
+            return CheckError(f"UNKNOWN: Requests to the bucket {bucketName} are throttled by S3", 3)
+        return CheckError(f"CRITICAL: Error code: {e.response['Error']}", 2)
+
+    # Split the keys of the folder into ranges at the shard boundaries (e.g. "2023,2024" for "2023-01-01.tar.gz"),
+    # so the ranges can be listed in parallel. Returns start keys and last keys of the ranges in the key order.
+    @staticmethod
+    def shardRanges(folderName, shards):
+        boundaries = sorted(set(f"{folderName}/{shard}" for shard in shards))
+        return [None] + boundaries, boundaries + [None]
+
+    # Parameters of the listing of files in the folder with keys after startKey (optional).
+    @staticmethod
+    def rangeParams(bucketName, folderName, startKey):
+        params = {"Bucket": bucketName, "Prefix": folderName}
+        if startKey is not None:
+            params["StartAfter"] = startKey
+        return params
+
+    # Files of a listing page with keys up to lastKey (optional). Returns the files and whether the range ends in the page.
+    @staticmethod
+    def rangeFiles(page, lastKey):
+        files = page.get("Contents", [])
+        if lastKey is not None and files and files[-1]["Key"] > lastKey:
+            return [obj for obj in files if obj["Key"] <= lastKey], True
+        return files, False
+
+    # Get the first file of the folder from a listing with MaxKeys=1.
+    @staticmethod
+    def firstOf(response, folderName):
+        files = response.get("Contents", [])
+        if not files:
+            raise CheckError("CRITICAL: No file found in folder " + folderName.rstrip("/"), 2)
+        return files[0]
+
+
+class S3Service(BaseS3Service):
+    # Sessions and clients by profile name. Creating a session loads the AWS config and credentials files,
+    # so it is done only once per process and the (thread-safe) client with its connection pool is reused.
+    sessions = {}
+    clients = {}
+
+    def __init__(self, profile, logger = Logger(False), maxConnections = 32):
+        super().__init__(profile, logger, maxConnections)
+        if self.profile not in S3Service.sessions:
+            session = boto3.Session(profile_name=self.profile)
+            S3Service.sessions[self.profile] = session
+            S3Service.clients[self.profile] = session.client("s3", config=self.clientConfig())
+        self.session = S3Service.sessions[self.profile]
+        self.s3 = S3Service.clients[self.profile]
 
     # Check if the bucket exists. Returns True if it does, False if it doesn't.
     def checkBucketExists(self, bucketName):
@@ -83,28 +330,235 @@ class S3Service:
         except botocore.exceptions.ClientError as e:
             error_code = int(e.response["Error"]["Code"])
             if error_code == 404:
-                self.logger.info(f"CRITICAL: No bucket found with a name of {str(bucketName)}")
+                self.logger.info(f"CRITICAL: No bucket found with a name of {bucketName}")
             else:
                 self.logger.info(f"CRITICAL: Error code: {e.response['Error']}")
 
             return False
-
-    def listFolders(self, bucketName):
+        except botocore.exceptions.BotoCoreError as e:
+            raise self.statusError(e, bucketName) from e
+
+    # List top-level folders in the bucket starting with the prefix. Yields folder names page by page.
+    # A bucket without folders is CRITICAL, while no folder matching the prefix yields nothing, as before
+    # the folders were filtered by S3.
+    def listFolders(self, bucketName, prefix=""):
+        found = False
         try:
-            foldersObject = self.s3.list_objects_v2(Bucket=bucketName, Delimiter="/")["CommonPrefixes"]
-            return list(map(lambda x: x["Prefix"].rstrip("/"), foldersObject))
-        except Exception as e:
-            self.logger.info("CRITICAL: No folder found in bucket " + str(bucketName))
-            self.logger.debug(str(e))
-            exit(2)
-
-    def listFiles(self, bucketName, folderName):
+            paginator = self.s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=bucketName, Prefix=prefix, Delimiter="/"):
+                for commonPrefix in page.get("CommonPrefixes", []):
+                    found = True
+                    yield commonPrefix["Prefix"].rstrip("/")
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            raise self.statusError(e, bucketName) from e
+
+        if not found and not prefix:
+            raise CheckError("CRITICAL: No folder found in bucket " + bucketName, 2)
+
+    # List files in the folder with keys after startKey up to lastKey (both optional). Yields file objects page by page.
+    def listFileRange(self, bucketName, folderName, startKey, lastKey):
         try:
-            return self.s3.list_objects_v2(Bucket=bucketName, Prefix=folderName)["Contents"]
-        except Exception as e:
-            self.logger.info("CRITICAL: No file found in folder " + str(folderName))
-            self.logger.debug(str(e))
-            exit(2)
+            paginator = self.s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(**self.rangeParams(bucketName, folderName, startKey)):
+                files, rangeEnds = self.rangeFiles(page, lastKey)
+                yield from files
+                if rangeEnds:
+                    return
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            raise self.statusError(e, bucketName) from e
+
+    # Get the manifest of the latest S3 Inventory report of the bucket. Returns None if there is no usable
+    # report (missing, invalid, older than maxAge seconds, of another bucket, not in the CSV format or without
+    # the Size and LastModifiedDate fields).
+    # The prefix is the inventory destination prefix including the source bucket and the inventory name.
+    def latestInventory(self, bucketName, inventoryBucket, inventoryPrefix, maxAge=24 * 3600):
+        inventoryPrefix = inventoryPrefix.rstrip("/") + "/"
+        try:
+            # Reports are stored in folders named by their date (e.g. 2020-01-01T01-00Z), next to "data" and "hive".
+            reports = []
+            paginator = self.s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=inventoryBucket, Prefix=inventoryPrefix, Delimiter="/"):
+                for commonPrefix in page.get("CommonPrefixes", []):
+                    if commonPrefix["Prefix"][len(inventoryPrefix):][:1].isdigit():
+                        reports.append(commonPrefix["Prefix"])
+            if not reports:
+                self.logger.debug("No inventory report found in %s/%s", inventoryBucket, inventoryPrefix)
+                return None
+
+            manifestKey = max(reports) + "manifest.json"
+            manifest = json.load(self.s3.get_object(Bucket=inventoryBucket, Key=manifestKey)["Body"])
+            age = time.time() - int(manifest["creationTimestamp"]) / 1000
+            sourceBucket = manifest["sourceBucket"]
+            fileFormat = manifest["fileFormat"]
+            columns = [column.strip() for column in manifest["fileSchema"].split(",")]
+            # Only the keys of the data files are used, a malformed list is rejected here as well.
+            manifest["files"] = [{"key": dataFile["key"]} for dataFile in manifest["files"]]
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            self.logger.debug("Inventory report could not be read: %s", e)
+            return None
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            self.logger.debug("Inventory report %s is invalid: %r", manifestKey, e)
+            return None
+
+        if age > maxAge:
+            self.logger.debug("Inventory report %s is %d hours old", manifestKey, age / 3600)
+            return None
+        if sourceBucket != bucketName:
+            self.logger.debug("Inventory report %s is for the bucket %s", manifestKey, sourceBucket)
+            return None
+        if fileFormat != "CSV":
+            self.logger.debug("Inventory report %s is in the unsupported format %s", manifestKey, fileFormat)
+            return None
+        missingColumns = [column for column in ("Key", "Size", "LastModifiedDate") if column not in columns]
+        if missingColumns:
+            self.logger.debug("Inventory report %s has no %s fields", manifestKey, ", ".join(missingColumns))
+            return None
+
+        self.logger.debug("Using inventory report %s", manifestKey)
+        manifest["inventoryBucket"] = inventoryBucket
+        return manifest
+
+    # List files in the S3 Inventory report with keys starting with the prefix, yields file objects in the same
+    # format as listFileRange. The CSV files are streamed, or with select, filtered by the prefix on the S3 side
+    # using S3 Select.
+    def listInventoryFiles(self, manifest, prefix="", select=False):
+        columns = [column.strip() for column in manifest["fileSchema"].split(",")]
+        if select:
+            columns, rows = self.selectInventoryRows(manifest, columns, prefix)
+        else:
+            rows = self.readInventoryRows(manifest)
+
+        keyIndex = columns.index("Key")
+        sizeIndex = columns.index("Size")
+        lastModifiedIndex = columns.index("LastModifiedDate")
+        storageClassIndex = columns.index("StorageClass") if "StorageClass" in columns else None
+        # Reports of versioned buckets list all versions and delete markers as well.
+        isLatestIndex = columns.index("IsLatest") if "IsLatest" in columns else None
+        isDeleteMarkerIndex = columns.index("IsDeleteMarker") if "IsDeleteMarker" in columns else None
+
+        for row in rows:
+            if isLatestIndex is not None and row[isLatestIndex] != "true":
+                continue
+            if isDeleteMarkerIndex is not None and row[isDeleteMarkerIndex] == "true":
+                continue
+            # Skip the keys outside the prefix before the other fields are parsed, most rows of a bucket-wide report.
+            key = unquote_plus(row[keyIndex])
+            if not key.startswith(prefix):
+                continue
+            yield {
+                "Key": key,
+                "Size": int(row[sizeIndex]),
+                "LastModified": isoparse(row[lastModifiedIndex]),
+                "StorageClass": row[storageClassIndex] if storageClassIndex is not None else "",
+            }
+
+    # Read all rows of the inventory report CSV files.
+    def readInventoryRows(self, manifest):
+        try:
+            for dataFile in manifest["files"]:
+                body = self.s3.get_object(Bucket=manifest["inventoryBucket"], Key=dataFile["key"])["Body"]
+                with io.TextIOWrapper(gzip.GzipFile(fileobj=body), encoding="utf-8", newline="") as reader:
+                    yield from csv.reader(reader)
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            raise self.statusError(e, manifest["inventoryBucket"]) from e
+
+    # Query the inventory report CSV files with S3 Select, so only the needed columns of the rows
+    # with keys starting with the prefix are transferred. Returns the selected columns and the rows.
+    def selectInventoryRows(self, manifest, columns, prefix):
+        selected = [column for column in columns if column in ("Key", "Size", "LastModifiedDate", "StorageClass")]
+        # Columns of a CSV file without a header are referenced by their position.
+        fields = {column: f"s._{columns.index(column) + 1}" for column in columns}
+        conditions = []
+        if prefix:
+            # Keys are URL encoded in the report. Wildcards in the prefix may only match more rows,
+            # which are then skipped by the folder match of the caller.
+            encodedPrefix = quote_plus(prefix, safe="/").replace("'", "''")
+            conditions.append(f"{fields['Key']} LIKE '{encodedPrefix}%'")
+        if "IsLatest" in columns:
+            conditions.append(f"{fields['IsLatest']} = 'true'")
+        if "IsDeleteMarker" in columns:
+            conditions.append(f"{fields['IsDeleteMarker']} <> 'true'")
+
+        expression = "SELECT " + ", ".join(fields[column] for column in selected) + " FROM S3Object s"
+        if conditions:
+            expression += " WHERE " + " AND ".join(conditions)
+        self.logger.debug("Inventory query: %s", expression)
+        return selected, self.selectRows(manifest, expression)
+
+    # Run the query on each inventory report CSV file, yields the rows of the results.
+    # S3 Select is not available to every account, its errors are UNKNOWN except for the access errors.
+    def selectRows(self, manifest, expression):
+        try:
+            for dataFile in manifest["files"]:
+                response = self.s3.select_object_content(Bucket=manifest["inventoryBucket"], Key=dataFile["key"],
+                                                         Expression=expression, ExpressionType="SQL",
+                                                         InputSerialization={"CSV": {}, "CompressionType": "GZIP"},
+                                                         OutputSerialization={"CSV": {}})
+                # A row may be split between two events, the incomplete last line is kept for the next one.
+                pending = b""
+                for event in response["Payload"]:
+                    if "Records" in event:
+                        lines = (pending + event["Records"]["Payload"]).split(b"\n")
+                        pending = lines.pop()
+                        yield from csv.reader(line.decode("utf-8") for line in lines)
+                if pending:
+                    yield from csv.reader([pending.decode("utf-8")])
+        except botocore.exceptions.ClientError as e:
+            error = self.statusError(e, manifest["inventoryBucket"])
+            if error.exitcode == 2:
+                errorCode = e.response["Error"]["Code"]
+                error = CheckError(f"UNKNOWN: S3 Select query of the inventory report failed ({errorCode}), "
+                                   "run the check without --inventory-select", 3)
+            raise error from e
+        except botocore.exceptions.BotoCoreError as e:
+            raise self.statusError(e, manifest["inventoryBucket"]) from e
+
+    # Get the first file of the folder in the key order. A single request regardless of the folder size.
+    def firstFile(self, bucketName, folderName):
+        try:
+            response = self.s3.list_objects_v2(Bucket=bucketName, Prefix=folderName, MaxKeys=1)
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            raise self.statusError(e, bucketName) from e
+        return self.firstOf(response, folderName)
+
+
+# Asynchronous variant of the S3Service file listings, using aioboto3. Must be used as an async context manager,
+# which opens and closes the client.
+class AsyncS3Service(BaseS3Service):
+    def __init__(self, profile, logger = Logger(False), maxConnections = 32):
+        super().__init__(profile, logger, maxConnections)
+        self.session = aioboto3.Session(profile_name=self.profile)
+        self.client = None
+        self.s3 = None
+
+    async def __aenter__(self):
+        self.client = self.session.client("s3", config=self.clientConfig())
+        self.s3 = await self.client.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.__aexit__(*exc)
+
+    # List files in the folder with keys after startKey up to lastKey (both optional). Yields file objects page by page.
+    async def listFileRange(self, bucketName, folderName, startKey, lastKey):
+        try:
+            paginator = self.s3.get_paginator("list_objects_v2")
+            async for page in paginator.paginate(**self.rangeParams(bucketName, folderName, startKey)):
+                files, rangeEnds = self.rangeFiles(page, lastKey)
+                for obj in files:
+                    yield obj
+                if rangeEnds:
+                    return
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            raise self.statusError(e, bucketName) from e
+
+    # Get the first file of the folder in the key order. A single request regardless of the folder size.
+    async def firstFile(self, bucketName, folderName):
+        try:
+            response = await self.s3.list_objects_v2(Bucket=bucketName, Prefix=folderName, MaxKeys=1)
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            raise self.statusError(e, bucketName) from e
+        return self.firstOf(response, folderName)
 
 
 # Parse command line arguments
@@ -116,7 +570,8 @@ parser.add_argument("--bucketname", dest="bucketname", type=str, required=True,
                     help="Name of S3 bucket")
 
 parser.add_argument("--bucketfolder", dest="bucketfolder", type=str, default="",
-                    help="Folder to check inside bucket (optional).")
+                    help="Folder to check inside bucket (optional). All folders starting with this name \
+                          (plain text, not a regular expression) are checked.")
 
 parser.add_argument("--minfirstage", dest="minfirstage", type=int, default=0,
                     help="Minimum age for the oldest backup in an S3 bucket in hours. \
@@ -129,17 +584,72 @@ parser.add_argument("--maxlastage", dest="maxlastage", type=int, default=0,
 parser.add_argument("--checksize", action="store_true",
                     help="Check the size of the last backup in the bucket. Default is 1 (enabled).")
 
+parser.add_argument("--sorted-keys", dest="sortedkeys", action="store_true",
+                    help="File names contain a sortable date (e.g. backup-2020-01-01.tar.gz), so the alphabetical \
+                          order of the files is also the order of their age.")
+
+parser.add_argument("--cache-ttl", dest="cachettl", type=int, default=3600,
+                    help="With --sorted-keys, the folder stats are cached in ~/.cache/check_s3_backups and only \
+                          the files added since the last run are listed. The folders are fully listed again after \
+                          this many seconds. Default is 3600.")
+
+parser.add_argument("--no-cache", dest="nocache", action="store_true",
+                    help="Do not use the cache of the folder stats.")
+
+parser.add_argument("--avg-window", dest="avgwindow", type=int, default=0,
+                    help="Compute the average size used by --checksize from the N youngest files only. \
+                          Default is 0 (all files in the folder).")
+
+parser.add_argument("--shards", dest="shards", type=str, default="",
+                    help="Comma separated file name prefixes (e.g. 2023,2024 or 1,2,3,4,5,6,7,8,9,a,b,c,d,e,f) \
+                          used to split the listing of each folder into parallel requests. Default is disabled.")
+
+parser.add_argument("--inventory-bucket", dest="inventorybucket", type=str, default="",
+                    help="Bucket with the S3 Inventory reports of the checked bucket (optional). The latest CSV \
+                          report is read instead of listing the folders. Reports older than 24 hours are ignored. \
+                          Files uploaded after the report are listed live with --sorted-keys, otherwise reports \
+                          older than half of --maxlastage are ignored too.")
+
+parser.add_argument("--inventory-prefix", dest="inventoryprefix", type=str, default="",
+                    help="Prefix of the S3 Inventory reports, required with --inventory-bucket, including the source \
+                          bucket and inventory name \
+                          (e.g. inventory/mainbackup/daily).")
+
+parser.add_argument("--inventory-select", dest="inventoryselect", action="store_true",
+                    help="Filter the S3 Inventory report by --bucketfolder on the S3 side using S3 Select, \
+                          instead of downloading the whole report.")
+
 parser.add_argument("--aws-profile", dest="profile", type=str, default="default",
                     help="AWS profile name from ~/.aws/credentials file. Default is 'default'.")
 
+parser.add_argument("--no-async", dest="noasync", action="store_true",
+                    help="List the folders by a thread pool even if aioboto3 is installed.")
+
+parser.add_argument("--verify-bucket", dest="verifybucket", action="store_true",
+                    help="Check that the bucket exists before listing it. A missing bucket is reported \
+                          by the listing too, so this only costs an extra request.")
+
+parser.add_argument("--no-ec2-metadata", dest="noec2metadata", action="store_true",
+                    help="Do not look for credentials in the EC2 instance metadata service. \
+                          Speeds up the check when not running on EC2.")
+
 parser.add_argument("--listfiles", action="store_true",
                     help="Enables listing of all latest backups in bucket to stdout. \
                           Use with caution!")
 
+parser.add_argument("--max-workers", dest="maxworkers", type=int, default=16,
+                    help="Number of folders listed concurrently. Default is 16.")
+
 parser.add_argument("--debug", action="store_true",
                     help="Enables debug output.")
 
 args = parser.parse_args()
+if args.avgwindow < 0:
+    parser.error("--avg-window must not be negative")
+if args.maxworkers < 1:
+    parser.error("--max-workers must be at least 1")
+if args.inventorybucket and not args.inventoryprefix:
+    parser.error("--inventory-bucket requires --inventory-prefix")
 
 # Assign variables from command line arguments
 logger = Logger(args.debug)
@@ -147,9 +657,12 @@ bucketname = args.bucketname
 minfirstage = args.minfirstage
 maxlastage = args.maxlastage
 bucketfolder = args.bucketfolder
-bucketfolder_regex = "^" + bucketfolder
+shards = [shard for shard in args.shards.split(",") if shard]
 maxagetime = datetime.datetime.now(tzutc()) - datetime.timedelta(hours=maxlastage)
 minagetime = datetime.datetime.now(tzutc()) - datetime.timedelta(hours=minfirstage)
+# The boundaries as epoch seconds, compared with the file times as plain floats.
+maxagetimestamp = maxagetime.timestamp()
+minagetimestamp = minagetime.timestamp()
 
 maxfilecount = 0
 minfilecount = 0
@@ -158,78 +671,245 @@ sizeWarningCount = 0
 sizeErrorCount = 0
 
 logger.debug("########## START DEBUG OUTPUT ############")
-logger.debug("S3 BUCKET NAME: " + str(bucketname))
-logger.debug("MIN FILE AGE: " + str(minfirstage))
-logger.debug("MAX FILE AGE: " + str(maxlastage))
-logger.debug("S3 profile name: " + str(args.profile))
-logger.debug("MAX AGE TIME: " + str(maxagetime))
-logger.debug("MIN AGE TIME: " + str(minagetime))
+logger.debug("S3 BUCKET NAME: %s", bucketname)
+logger.debug("MIN FILE AGE: %s", minfirstage)
+logger.debug("MAX FILE AGE: %s", maxlastage)
+logger.debug("S3 profile name: %s", args.profile)
+logger.debug("MAX AGE TIME: %s", maxagetime)
+logger.debug("MIN AGE TIME: %s", minagetime)
 
 logger.debug("Connecting to S3")
 
-s3Service = S3Service(args.profile, logger)
-
-# Check if the bucket exists
-s3Service.checkBucketExists(bucketname)
-logger.debug(f"Hooray the bucket {str(bucketname)} was found!")
-
-folders = s3Service.listFolders(bucketname)
-logger.debug(f"Folders: {folders}")
+if args.noec2metadata:
+    os.environ["AWS_EC2_METADATA_DISABLED"] = "true"
+
+# Each of the maxworkers folders is listed by a request per shard range at the same time.
+maxConnections = args.maxworkers * (len(shards) + 1)
+s3Service = S3Service(args.profile, logger, maxConnections)
+
+
+# Folders are listed with a trailing slash, so a folder (service1) does not match the keys of folders
+# sharing its name (service10) or of objects next to it (service1.tar).
+def scanRange(folder, startKey, lastKey):
+    stats = FolderStats(args.sortedkeys, args.avgwindow)
+    for file in s3Service.listFileRange(bucketname, folder + "/", startKey, lastKey):
+        stats.add(file)
+    return stats
+
+
+# Decide how the folder is scanned, the same way for the thread pool and the asyncio scan. Returns the stats
+# to add the files to, the key ranges to list (None if only the first file is needed) and the listing time for the cache.
+def planFolder(folder):
+    stats = FolderStats(args.sortedkeys, args.avgwindow)
+    # Only the oldest file is needed, with sorted keys it is the first one listed.
+    if args.sortedkeys and maxlastage == 0 and not args.checksize and not args.listfiles:
+        return stats, None, None
+
+    # With sorted keys, new files come after the youngest cached one, so only those have to be listed.
+    if cache is not None:
+        entry = cache.get(folder)
+        if entry is not None and entry["avgWindow"] == args.avgwindow:
+            stats = FolderStats.fromDict(entry["stats"], args.sortedkeys, args.avgwindow)
+            return stats, [(stats.youngest["Key"], None)], entry["listedAt"]
+
+    # With shards, each range is scanned by its own worker, the stats of the ranges are merged in the key order.
+    if shards:
+        return stats, list(zip(*s3Service.shardRanges(folder, shards))), time.time()
+    return stats, [(None, None)], time.time()
+
+
+def finishFolder(folder, stats, listedAt):
+    if stats.count == 0:
+        raise CheckError("CRITICAL: No file found in folder " + folder, 2)
+    if cache is not None:
+        cache.put(folder, stats, listedAt, args.avgwindow)
+    return stats
+
+
+def scanFolder(folder):
+    stats, ranges, listedAt = planFolder(folder)
+    if ranges is None:
+        stats.add(s3Service.firstFile(bucketname, folder + "/"))
+        return stats
+
+    if len(ranges) == 1:
+        stats.merge(scanRange(folder, *ranges[0]))
+    else:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            for rangeStats in executor.map(scanRange, repeat(folder), *zip(*ranges)):
+                stats.merge(rangeStats)
+    return finishFolder(folder, stats, listedAt)
+
+
+# List the folders concurrently, returns their stats in the folder order. On the first error the folders
+# not started yet are cancelled, so only one status is reported.
+def scanFolders(folders):
+    with ThreadPoolExecutor(max_workers=args.maxworkers) as executor:
+        futures = [executor.submit(scanFolder, folder) for folder in folders]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+async def scanRangeAsync(asyncService, folder, startKey, lastKey):
+    stats = FolderStats(args.sortedkeys, args.avgwindow)
+    async for file in asyncService.listFileRange(bucketname, folder + "/", startKey, lastKey):
+        stats.add(file)
+    return stats
+
+
+# Same as scanFolder, using aioboto3.
+async def scanFolderAsync(asyncService, folder, semaphore):
+    async with semaphore:
+        stats, ranges, listedAt = planFolder(folder)
+        if ranges is None:
+            stats.add(await asyncService.firstFile(bucketname, folder + "/"))
+            return stats
+
+        for rangeStats in await gatherAll(scanRangeAsync(asyncService, folder, *keyRange) for keyRange in ranges):
+            stats.merge(rangeStats)
+        return finishFolder(folder, stats, listedAt)
+
+
+# Run the coroutines concurrently and return their results. When one of them fails, the others are cancelled
+# and awaited before the error is raised, so no task is left running or with an unretrieved error.
+async def gatherAll(coroutines):
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+# List the folders concurrently on a single event loop, at most maxworkers folders at a time.
+async def scanFoldersAsync(folders):
+    semaphore = asyncio.Semaphore(args.maxworkers)
+    async with AsyncS3Service(args.profile, logger, maxConnections) as asyncService:
+        return await gatherAll(scanFolderAsync(asyncService, folder, semaphore) for folder in folders)
+
+
+# Add the files uploaded after the inventory report to the folder stats. With sorted keys,
+# those come after the youngest file of the report.
+def scanFolderAfterInventory(folder, stats):
+    startKey = stats.youngest["Key"] if stats.youngest is not None else None
+    for file in s3Service.listFileRange(bucketname, folder + "/", startKey, None):
+        stats.add(file)
+
+
+# Get the stats of all folders from a single pass over the inventory report.
+def scanInventory(folders, manifest):
+    # The files are not in the key order in the report, so sortedKeys is not used.
+    folderStats = {folder: FolderStats(False, args.avgwindow) for folder in folders}
+    for file in s3Service.listInventoryFiles(manifest, bucketfolder, args.inventoryselect):
+        folder = file["Key"].split("/", 1)[0]
+        if folder in folderStats:
+            folderStats[folder].add(file)
+
+    if args.sortedkeys:
+        with ThreadPoolExecutor(max_workers=args.maxworkers) as executor:
+            list(executor.map(scanFolderAfterInventory, folderStats.keys(), folderStats.values()))
+
+    for folder, stats in folderStats.items():
+        if stats.count == 0:
+            raise CheckError("CRITICAL: No file found in folder " + folder, 2)
+    return folderStats.values()
+
+
+cache = None
+if args.sortedkeys and not args.nocache:
+    cache = StatsCache(bucketname, args.cachettl, logger)
+
+try:
+    # Check if the bucket exists. The folder listing reports a missing bucket as well, so this is optional.
+    if args.verifybucket:
+        if not s3Service.checkBucketExists(bucketname):
+            exit(2)
+        logger.debug("Hooray the bucket %s was found!", bucketname)
+
+    # List the folders matching the requested name first, so that only those are scanned.
+    # The name is used as a prefix, so S3 filters the folders itself.
+    folders = list(s3Service.listFolders(bucketname, bucketfolder))
+    logger.debug("Folders: %s", folders)
+
+    manifest = None
+    if args.inventorybucket:
+        # Files uploaded after the report are missing from it. Without sorted keys they cannot be listed
+        # separately, so the report must be young enough not to make the youngest backup look too old.
+        maxInventoryAge = 24 * 3600
+        if maxlastage > 0 and not args.sortedkeys:
+            maxInventoryAge = min(maxInventoryAge, maxlastage * 3600 / 2)
+        manifest = s3Service.latestInventory(bucketname, args.inventorybucket, args.inventoryprefix, maxInventoryAge)
+
+    if manifest is not None:
+        results = scanInventory(folders, manifest)
+    elif aioboto3 is not None and not args.noasync:
+        results = asyncio.run(scanFoldersAsync(folders))
+    else:
+        results = scanFolders(folders)
+except CheckError as e:
+    logger.info(e.message)
+    exit(e.exitcode)
 
 # Loop through folders in the S3 bucket and for each of them get the oldest file.
 # For each of them, check age and size.
-for folder in folders:
-    if re.match(bucketfolder_regex, str(folder)):
-        files = s3Service.listFiles(bucketname, folder)
-        sortedFiles = sorted(files, key=lambda x: x["LastModified"], reverse=True)
-        youngestFile = sortedFiles[0]
-        oldestFile = sortedFiles[-1]
+for stats in results:
+    youngestFile = stats.youngest
+    oldestFile = stats.oldest
+    if args.listfiles:
+        logger.info(f"{youngestFile['Key']}|{youngestFile['StorageClass']}|{youngestFile['LastModified']}|{youngestFile['Size']}")
+
+    if maxlastage > 0 and youngestFile["LastModified"].timestamp() < maxagetimestamp:
         if args.listfiles:
-            logger.info(f"{youngestFile['Key']}|{youngestFile['StorageClass']}|{str(youngestFile['LastModified'])}|{youngestFile['Size']}")
-
-        if youngestFile["LastModified"] < maxagetime:
-            if args.listfiles:
-                logger.info(f"Found backup older than maxlastage of {str(maxlastage)} hours: {youngestFile['Key']}")
-            maxfilecount += 1
-
-        if minfirstage > 0 and oldestFile["LastModified"] > minagetime:
-            if args.listfiles:
-                logger.info(f"Found file newer than minfirstage of {str(minfirstage)} hours: {oldestFile['Key']}")
-            minfilecount += 1
-        totalfilecount += 1
-
-        if args.checksize:
-            totalSize = sum(map(lambda x: x["Size"], files))
-            averageSize = totalSize / len(files)
-            if youngestFile["Size"] < averageSize / 2:
-                logger.info(f"File size of {youngestFile['Key']} is less than 50% of average size")
-                sizeWarningCount += 1
-
-            if youngestFile["Size"] == 0:
-                logger.info(f"CRITICAL: File size of {youngestFile['Key']} is 0")
-                sizeErrorCount += 1
+            logger.info(f"Found backup older than maxlastage of {maxlastage} hours: {youngestFile['Key']}")
+        maxfilecount += 1
+
+    if minfirstage > 0 and oldestFile["LastModified"].timestamp() > minagetimestamp:
+        if args.listfiles:
+            logger.info(f"Found file newer than minfirstage of {minfirstage} hours: {oldestFile['Key']}")
+        minfilecount += 1
+    totalfilecount += 1
+
+    if args.checksize:
+        averageSize = stats.averageSize()
+        if youngestFile["Size"] < averageSize / 2:
+            logger.info(f"File size of {youngestFile['Key']} is less than 50% of average size")
+            sizeWarningCount += 1
+
+        if youngestFile["Size"] == 0:
+            logger.info(f"CRITICAL: File size of {youngestFile['Key']} is 0")
+            sizeErrorCount += 1
+
+if cache is not None:
+    cache.save()
 
 # Begin formatting the status message for Nagios output
 # This is conditionally formatted based on requested min/max options.
-msg = " -"
+parts = [" -"]
 if minfirstage > 0:
-    msg += f" MIN:{str(minfirstage)}hrs"
+    parts.append(f" MIN:{minfirstage}hrs")
 if maxlastage > 0:
-    msg += f" MAX:{str(maxlastage)}hrs"
+    parts.append(f" MAX:{maxlastage}hrs")
 
 if maxlastage > 0:
-    msg += " - Files exceeding MAX time: " + str(maxfilecount)
+    parts.append(f" - Files exceeding MAX time: {maxfilecount}")
 
 if minfirstage > 0:
-    msg += " - Files before MIN time: " + str(minfilecount)
+    parts.append(f" - Files before MIN time: {minfilecount}")
 
 if sizeWarningCount > 0:
-    msg += " - File with SIZE warning: " + str(sizeWarningCount)
+    parts.append(f" - File with SIZE warning: {sizeWarningCount}")
 
 if sizeErrorCount > 0:
-    msg += " - File with SIZE error: " + str(sizeErrorCount)
+    parts.append(f" - File with SIZE error: {sizeErrorCount}")
 
-msg += " - Total file count: " + str(totalfilecount)
+parts.append(f" - Total file count: {totalfilecount}")
+msg = "".join(parts)
 
 # Decide exit code for Nagios based on maxfilecount, minfilecount, sizeWarning and sizeError results.
 #